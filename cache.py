@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Union
+import litellm
+import pypdfium2 as pdfium
+from crewai import LLM
+from crewai.knowledge.source.pdf_knowledge_source import PDFKnowledgeSource
+
+CACHE_DIR = "outputs/_cache"
+LLM_CACHE_PATH = os.path.join(CACHE_DIR, "llm_cache.sqlite3")
+SUMMARY_CACHE_DIR = os.path.join(CACHE_DIR, "summary")
+PDF_CACHE_DIR = os.path.join(CACHE_DIR, "pdf")
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+MIN_CACHEABLE_TOKENS = 1024  # Anthropic ignores cache breakpoints on shorter prefixes (Sonnet/Opus)
+
+
+def _connect(path: str = LLM_CACHE_PATH) -> sqlite3.Connection:
+    """Open the LLM response cache, creating it if needed."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses "
+        "(key TEXT PRIMARY KEY, response BLOB, ts INTEGER)"
+    )
+    return conn
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_ttl_days() -> int:
+    """Cache retention in days, configurable via PODCAST_CACHE_TTL_DAYS."""
+    return int(os.getenv("PODCAST_CACHE_TTL_DAYS", "30"))
+
+
+def prune_llm_cache(ttl_days: Optional[int] = None, path: str = LLM_CACHE_PATH) -> None:
+    """Drop cached LLM responses older than the TTL."""
+    if ttl_days is None:
+        ttl_days = cache_ttl_days()
+    cutoff = int(time.time()) - ttl_days * 86400
+    with _connect(path) as conn:
+        conn.execute("DELETE FROM responses WHERE ts < ?", (cutoff,))
+    conn.close()
+
+
+def prune_cache_dir(path: str, ttl_days: Optional[int] = None) -> None:
+    """Delete cached files older than the TTL, like `find -mtime +N -delete`."""
+    if ttl_days is None:
+        ttl_days = cache_ttl_days()
+    if not os.path.isdir(path):
+        return
+    cutoff = time.time() - ttl_days * 86400
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+
+def prune_caches(ttl_days: Optional[int] = None) -> None:
+    """Expire LLM responses, paper summaries and extracted PDF text older than the TTL."""
+    prune_llm_cache(ttl_days)
+    prune_cache_dir(SUMMARY_CACHE_DIR, ttl_days)
+    prune_cache_dir(PDF_CACHE_DIR, ttl_days)
+
+
+class CachedLLM(LLM):
+    """LLM that serves repeated prompts from a persistent SQLite cache."""
+
+    def _prepare_messages(self, messages: Union[str, List[Dict[str, Any]]]) -> Union[str, List[Dict[str, Any]]]:
+        """Hook for provider-specific message rewriting before caching and sending."""
+        return messages
+
+    def _cache_key(self, messages: Union[str, List[Dict[str, Any]]], tools: Optional[List[dict]]) -> str:
+        tools_hash = hashlib.sha256(
+            json.dumps(tools or [], sort_keys=True, default=str).encode()
+        ).hexdigest()
+        payload = (
+            f"{self.model}|{self.temperature}|"
+            f"{json.dumps(messages, sort_keys=True, default=str)}|{tools_hash}"
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[str]:
+        with _connect() as conn:
+            row = conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        conn.close()
+        return row[0] if row is not None else None
+
+    def _store(self, key: str, response: str) -> None:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, ts) VALUES (?, ?, ?)",
+                (key, response, int(time.time()))
+            )
+        conn.close()
+
+    def _stream_params(self) -> Dict[str, Any]:
+        """Extra provider parameters for streamed completions."""
+        return {}
+
+    def call(
+        self,
+        messages: Union[str, List[Dict[str, Any]]],
+        tools: Optional[List[dict]] = None,
+        callbacks: Optional[List[Any]] = None,
+        available_functions: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> str:
+        messages = self._prepare_messages(messages)
+
+        # Native function calls execute tools inside call(), so never replay them
+        if available_functions:
+            return super().call(messages, tools, callbacks, available_functions, **kwargs)
+
+        key = self._cache_key(messages, tools)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        response = super().call(messages, tools, callbacks, available_functions, **kwargs)
+        if response:
+            self._store(key, response)
+        return response
+
+    async def astream(
+        self,
+        messages: Union[str, List[Dict[str, Any]]],
+        validate: Optional[Callable[[str], Any]] = None
+    ) -> AsyncIterator[str]:
+        """Stream completion text as it is generated; cache hits arrive as one chunk.
+
+        The full response is only cached once `validate` accepts it without raising.
+        """
+        messages = self._prepare_messages(messages)
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+
+        key = self._cache_key(messages, None)
+        cached = self._lookup(key)
+        if cached is not None:
+            yield cached
+            return
+
+        chunks = []
+        stream = await litellm.acompletion(
+            model=self.model,
+            messages=messages,
+            temperature=self.temperature,
+            stream=True,
+            **self._stream_params()
+        )
+        async for part in stream:
+            text = part.choices[0].delta.content
+            if text:
+                chunks.append(text)
+                yield text
+
+        if not chunks:
+            return
+        response = "".join(chunks)
+        if validate is not None:
+            try:
+                validate(response)
+            except Exception:
+                # Never pin a truncated or malformed reply; the caller surfaces the error
+                return
+        self._store(key, response)
+
+
+class PromptCachingLLM(CachedLLM):
+    """LLM that prepends a frozen system prefix, marked for prompt caching on Anthropic."""
+
+    def __init__(self, model: str, system_prefix: str, **kwargs):
+        if model.startswith("anthropic/"):
+            kwargs.setdefault("extra_headers", PROMPT_CACHING_HEADERS)
+        super().__init__(model=model, **kwargs)
+        self.system_prefix = system_prefix
+        self._checked_cache_size = False
+
+    def _stream_params(self) -> Dict[str, Any]:
+        if not self.model.startswith("anthropic/"):
+            return {}
+        return {"extra_headers": PROMPT_CACHING_HEADERS}
+
+    def _prepare_messages(self, messages: Union[str, List[Dict[str, Any]]]) -> Union[str, List[Dict[str, Any]]]:
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+
+        system_texts = [self.system_prefix]
+        rest = []
+        for message in messages:
+            if message["role"] == "system" and isinstance(message["content"], str):
+                system_texts.append(message["content"])
+            else:
+                rest.append(message)
+
+        # The prefix carries the instructions, so every provider gets it
+        if not self.model.startswith("anthropic/"):
+            return [{"role": "system", "content": "\n\n".join(system_texts)}, *rest]
+
+        self._check_cache_size(system_texts)
+        system_blocks = [{"type": "text", "text": text} for text in system_texts]
+        # The agent's own system prompt is static too, so the breakpoint goes on the
+        # last system block to cache as long a prefix as possible
+        system_blocks[-1]["cache_control"] = {"type": "ephemeral"}
+        return [{"role": "system", "content": system_blocks}, *rest]
+
+    def _check_cache_size(self, system_texts: List[str]) -> None:
+        """Warn once if the cached prefix is too short for Anthropic to cache."""
+        if self._checked_cache_size:
+            return
+        self._checked_cache_size = True
+        tokens = litellm.token_counter(model=self.model, text="\n\n".join(system_texts))
+        if tokens < MIN_CACHEABLE_TOKENS:
+            print(
+                f"Prompt caching inactive for {self.model}: cached prefix is ~{tokens} tokens, "
+                f"below Anthropic's {MIN_CACHEABLE_TOKENS}-token minimum"
+            )
+
+
+class CachedPDFKnowledgeSource(PDFKnowledgeSource):
+    """PDF knowledge source that extracts text with pdfium and caches it by content hash."""
+
+    def load_content(self) -> Dict[Path, str]:
+        content = {}
+        for path in self.safe_file_paths:
+            path = self.convert_to_path(path)
+            content[path] = self._extract_text(path)
+        return content
+
+    def _extract_text(self, path: Path) -> str:
+        cache_file = os.path.join(PDF_CACHE_DIR, f"{file_digest(path)}.txt")
+        if os.path.exists(cache_file):
+            os.utime(cache_file)  # Expiry goes by mtime, so count the TTL from last use
+            with open(cache_file, encoding="utf-8") as f:
+                return f.read()
+
+        pages = []
+        pdf = pdfium.PdfDocument(str(path))
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                pages.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+        text = "\n".join(pages)
+
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        staged = f"{cache_file}.{os.getpid()}.tmp"
+        with open(staged, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(staged, cache_file)
+        return text
@@ -1,12 +1,20 @@
-from crewai import Agent, Task, Crew, Process, LLM
-from crewai.knowledge.source.pdf_knowledge_source import PDFKnowledgeSource
+from crewai import Agent, Task, Crew, Process
+from crewai.crews.crew_output import CrewOutput
+from crewai.tasks.output_format import OutputFormat
+from crewai.tasks.task_output import TaskOutput
 from crewai_tools import SerperDevTool
-from pydantic import BaseModel, Field
-from typing import List
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Union
 from datetime import datetime
 from dotenv import load_dotenv
+import asyncio
+import hashlib
+import json
 import os
-from tools import PodcastAudioGenerator, PodcastMixer, VoiceConfig
+import re
+import ijson
+from tools import ParallelSearchTool, PodcastAudioGenerator, PodcastMixer, VoiceConfig
+from cache import SUMMARY_CACHE_DIR, CachedLLM, CachedPDFKnowledgeSource, PromptCachingLLM, file_digest, prune_caches
 
 
 def setup_directories():
@@ -28,8 +36,13 @@ def setup_directories():
 # Load environment variables
 load_dotenv()
 
+# Expire stale cache entries before any agent runs
+prune_caches()
+
 # --- PDF Knowledge Source ---
-research_paper = PDFKnowledgeSource(file_paths="workplace-prod.pdf")
+PAPER_FILE = "workplace-prod.pdf"
+PAPER_PATH = os.path.join("knowledge", PAPER_FILE)  # PDFKnowledgeSource resolves files here
+research_paper = CachedPDFKnowledgeSource(file_paths=PAPER_FILE)
 
 # --- Pydantic Models definitions ---
 class PaperSummary(BaseModel):
@@ -57,22 +70,154 @@ class AudioGeneration(BaseModel):
     final_podcast: str = Field(..., description="Path to the final mixed podcast file")
 
 # --- LLM Setup ---
-summary_llm = LLM(
-    model="openai/o1-preview",
-    temperature=0.0,
-)
+if os.getenv("PODCAST_HIGH_QUALITY") == "1":
+    summary_llm = CachedLLM(
+        model="openai/o1-preview",
+        temperature=0.0,
+    )
+else:
+    # summary_task's output_pydantic already structures the answer as a PaperSummary
+    summary_llm = CachedLLM(
+        model="openai/gpt-4o-mini",
+        temperature=0.0,
+    )
 
-script_llm = LLM(
+script_llm = CachedLLM(
     model="openai/o1-preview",
     temperature=0.3,
 )
 
-script_enhancer_llm = LLM(
+# Static enhancer instructions, few-shot examples and output schema, kept byte-identical
+# across runs so Anthropic can reuse its prompt cache for them; run-varying content stays
+# in the task context. Together with the agent's system prompt this must stay above
+# Anthropic's 1024-token caching minimum for Sonnet (~1.5k tokens with the examples),
+# or the cache marker is ignored (PromptCachingLLM warns when it falls short).
+ENHANCER_SYSTEM_PREFIX = """Take the initial podcast script and enhance it to be more engaging 
+and conversational while maintaining its educational value. Weave in the supporting 
+research where it adds context, always clearly distinguishing it from the paper's findings.
+
+Supporting Research Attribution:
+    - "I recently read about..."
+    - "There's some interesting related work by..."
+    - "This reminds me of a recent case study..."
+    - "Building on this, other researchers have found..."
+Only use these for material that actually appears in the supporting research.
+
+IMPORTANT RULES:
+1. NEVER change the host names - always keep Julia and Guido exactly as they are
+2. NEVER add explicit reaction markers like *chuckles*, *laughs*, etc.
+3. NEVER add new hosts or characters
+
+Enhancement Guidelines:
+1. Add Natural Elements:
+    • Include natural verbal reactions ("Oh that's fascinating", "Wow", etc.)
+    • Keep all dialogue between Julia and Guido only
+    • Add relevant personal anecdotes or examples that fit their established roles:
+        - Julia as the knowledgeable expert
+        - Guido as the engaged and curious co-host
+    • Express reactions through words rather than action markers
+
+2. Improve Flow:
+    • Ensure smooth transitions between topics
+    • Add brief casual exchanges that feel natural
+    • Include moments of reflection or connection-making
+    • Balance technical depth with accessibility
+
+3. Maintain Quality:
+    • Keep all technical information accurate
+    • Ensure added content supports rather than distracts
+    • Preserve the core findings and insights
+    • Keep the overall length reasonable
+
+4. Add Engagement Techniques:
+    • Include thought-provoking analogies by both hosts
+    • Add relatable real-world examples
+    • Express enthusiasm through natural dialogue
+    • Include collaborative problem-solving moments
+    • Inject humor where appropriate and it has to be funny
+
+Natural Reaction Examples:
+✓ RIGHT: "Oh, that's fascinating!"
+✓ RIGHT: "Wait, that doesn't make sense!"
+✓ RIGHT: "Wait, really? I hadn't thought of it that way."
+✓ RIGHT: "That's such a great point."
+✗ WRONG: *chuckles* or *laughs* or any other action markers
+✗ WRONG: Adding new speakers or changing host names
+
+The goal is to make the content feel like a conversation between Julia and Guido
+who are genuinely excited about the topic, while ensuring listeners learn
+something valuable.
+
+Enhancement Examples:
+
+Example 1 - turning a flat explanation into a conversation
+BEFORE:
+    Julia: The authors propose a new attention mechanism that scales linearly with sequence length.
+    Guido: What does that mean?
+    Julia: It means longer documents can be processed with less memory.
+AFTER:
+    Julia: So the heart of this paper is a new attention mechanism, and the headline is that it
+           scales linearly with sequence length instead of quadratically.
+    Guido: Okay, linear versus quadratic - can you make that concrete for me?
+    Julia: Sure. Imagine a dinner party where every guest has to shake hands with every other
+           guest. Double the guests and you roughly quadruple the handshakes. That's standard
+           attention. Their approach is more like everyone waving to the room once.
+    Guido: Oh, that's a great picture. So doubling the document just doubles the work?
+    Julia: Exactly, which is why they can fit much longer documents into the same memory.
+
+Example 2 - bringing in supporting research without blurring the sources
+BEFORE:
+    Guido: Did they test it on real patients?
+    Julia: Yes, on a dataset of 2,000 chest X-rays from three hospitals.
+AFTER:
+    Guido: Here's what I always want to know with medical AI - did this ever touch real patients?
+    Julia: It did. The paper evaluates on about 2,000 chest X-rays collected from three hospitals.
+    Guido: Three hospitals matters, right? Different scanners, different populations.
+    Julia: It really does. And I recently read about a related study that found models trained
+           at a single hospital can lose a lot of accuracy when moved to another one. That's not
+           from this paper, but it's exactly why their multi-site setup is reassuring.
+    Guido: Wow, so the boring-sounding detail is actually the important one.
+
+Example 3 - adding humor and reflection while keeping the facts intact
+BEFORE:
+    Julia: The model needed 512 GPUs for three weeks.
+    Guido: That is expensive.
+    Julia: The authors note that smaller versions perform almost as well.
+AFTER:
+    Julia: Now for the part that made me wince: training took 512 GPUs running for three weeks.
+    Guido: Three weeks? My laptop gets warm opening a spreadsheet.
+    Julia: Ha, yours and mine both. But the authors are upfront about the cost, and they show
+           that the smaller versions get surprisingly close in performance.
+    Guido: Wait, really? So if you're a small lab, you're not locked out of this idea?
+    Julia: That's the encouraging takeaway. You lose a little accuracy, but the core insight
+           carries over at a fraction of the price.
+
+Example 4 - what NOT to do
+WRONG:
+    Julia: *laughs* That's wild!
+    Dr. Smith: As a third guest, I'd add that...
+    Guy: Let me jump in here.
+RIGHT:
+    Julia: Honestly, that result is wild.
+    Guido: I did not see that coming. Let me make sure I follow what they measured.
+Reactions stay in words, only Julia and Guido speak, and their names never change.
+
+Output Format:
+The final enhanced script must be a JSON object matching this schema:
+""" + json.dumps(PodcastScript.model_json_schema(), sort_keys=True)
+
+script_enhancer_llm = PromptCachingLLM(
+    model="anthropic/claude-3-5-sonnet-20241022",
+    system_prefix=ENHANCER_SYSTEM_PREFIX,
+    temperature=0.7,
+)
+
+research_llm = CachedLLM(
     model="anthropic/claude-3-5-sonnet-20241022",
     temperature=0.7,
 )
 
-audio_llm = LLM(
+audio_llm = CachedLLM(
     model="cerebras/llama3.3-70b",
     temperature=0.0,
 )
@@ -106,7 +251,7 @@ audio_generator.add_voice(
 )
 
 podcast_mixer = PodcastMixer(output_dir=dirs['FINAL'])
-search_tool = SerperDevTool()
+search_tool = ParallelSearchTool(search_tool=SerperDevTool())
 
 
 # --- Agents ---
@@ -130,7 +275,7 @@ research_support = Agent(
     credible sources and relevant discussions across various domains.""",
     verbose=True,
     tools=[search_tool],
-    llm=script_enhancer_llm
+    llm=research_llm
 )
 
 script_writer = Agent(
@@ -227,7 +372,9 @@ supporting_research_task = Task(
     • Comes from credible sources
     • Adds valuable context to the paper's topic
     • Provides concrete examples or applications
-    • Offers different viewpoints or approaches""",
+    • Offers different viewpoints or approaches
+    
+    Batch related search queries into a single search call so they run in parallel.""",
     expected_output="A structured collection of relevant supporting materials and examples",
     agent=research_support,
     context=[summary_task],
@@ -235,8 +382,10 @@ supporting_research_task = Task(
 )
 
 podcast_task = Task(
-    description="""Using the paper summary and supporting research, create an engaging and informative podcast conversation 
-    between Julia and Guido. Make it feel natural while clearly distinguishing between paper findings and supplementary research.
+    description="""Using the paper summary, create an engaging and informative podcast conversation 
+    between Julia and Guido. Make it feel natural while staying grounded in what the paper reports.
+    Do not cite outside studies, case studies or related work - supporting research is woven in
+    at a later stage.
 
     Source Attribution Guidelines:
     • For Paper Content:
@@ -244,18 +393,12 @@ podcast_task = Task(
         - "The researchers found that..."
         - "In their study, they discovered..."
         - "The paper's methodology showed..."
-    
-    • For Supporting Research:
-        - "I recently read about..."
-        - "There's some interesting related work by..."
-        - "This reminds me of a recent case study..."
-        - "Building on this, other researchers have found..."
 
     Host Dynamics:
     - Julia: A knowledgeable but relatable expert who:
         • Explains technical concepts with enthusiasm
         • Sometimes playfully challenges Guido's assumptions
-        • Clearly distinguishes between paper findings and broader context
+        • Clearly distinguishes between paper findings and her own interpretation
         • Occasionally plays devil's advocate on certain points
         • Admits when she's uncertain about specific aspects
         • Shares relevant personal experiences with AI and tech
@@ -265,7 +408,7 @@ podcast_task = Task(
     - Guido: An engaged and curious co-host who:
         • Asks insightful questions and follows interesting threads
         • Occasionally disagrees based on his practical experience
-        • Brings up relevant external examples and research
+        • Brings up relatable everyday examples
         • Respectfully pushes back on theoretical claims with real-world examples
         • Helps find middle ground in discussions
         • Helps make connections to practical applications
@@ -273,98 +416,50 @@ podcast_task = Task(
 
     Example Flow with Attribution:
     Julia: "The paper's findings show that RAG is superior for factual queries."
-    Guido: "That's interesting, because I recently read about a case study where..."
-    Julia: "Oh, that's a great point! While the researchers found X, these real-world examples show Y..."
+    Guido: "That's interesting, but how would that hold up for something like customer support?"
+    Julia: "Oh, that's a great question! The researchers actually tested X, and found Y..."
 
     Disagreement Guidelines:
     • Keep disagreements friendly and constructive
     • Use phrases like:
         - "I see what the paper suggests, but in practice..."
-        - "While the study found X, other research shows..."
-        - "That's an interesting finding, though recent developments suggest..."
+        - "That's an interesting finding, though I wonder whether..."
     • Always find common ground or learning points
     • Use disagreements to explore nuances
     • Resolve differences with mutual understanding
 
     Conversation Flow:
     1. Core Discussion: Focus on the research and findings
-    2. Natural Tangents with Clear Attribution:
+    2. Natural Tangents:
         • "Building on the paper's findings..."
-        • "This relates to some recent developments..."
-        • "While not covered in the paper, there's interesting work on..."
+        • "Think about what this means for..."
     3. Smooth Returns: Natural ways to bring the conversation back:
         • "Coming back to what the researchers found..."
         • "This actually connects to the paper's methodology..."
         • "That's a great example of what the study was trying to solve..."
 
     Writing Guidelines:
-    1. Clearly distinguish paper findings from supplementary research
+    1. Attribute findings to the paper clearly
     2. Use attribution phrases naturally within the conversation
-    3. Connect different sources of information meaningfully
-    4. Keep technical content accurate but conversational
-    5. Maintain engagement through relatable stories
-    6. Include occasional friendly disagreements
-    7. Show how different perspectives and sources enrich understanding
+    3. Keep technical content accurate but conversational
+    4. Maintain engagement through relatable stories
+    5. Include occasional friendly disagreements
+    6. Show how different perspectives enrich understanding
     
     Note: Convey reactions through natural language rather than explicit markers like *laughs*.""",
-    expected_output="A well-balanced podcast script that clearly distinguishes between paper content and supplementary research.",
+    expected_output="A well-balanced podcast script grounded in the paper's content.",
     agent=script_writer,
-    context=[summary_task, supporting_research_task],
+    context=[summary_task],
     output_pydantic=PodcastScript,
     output_file="output/metadata/podcast_script.json"
 )
 
 enhance_script_task = Task(
-    description="""Take the initial podcast script and enhance it to be more engaging 
-    and conversational while maintaining its educational value.
-    
-    IMPORTANT RULES:
-    1. NEVER change the host names - always keep Julia and Guido exactly as they are
-    2. NEVER add explicit reaction markers like *chuckles*, *laughs*, etc.
-    3. NEVER add new hosts or characters
-    
-    Enhancement Guidelines:
-    1. Add Natural Elements:
-        • Include natural verbal reactions ("Oh that's fascinating", "Wow", etc.)
-        • Keep all dialogue between Julia and Guido only
-        • Add relevant personal anecdotes or examples that fit their established roles:
-            - Julia as the knowledgeable expert
-            - Guido as the engaged and curious co-host
-        • Express reactions through words rather than action markers
-    
-    2. Improve Flow:
-        • Ensure smooth transitions between topics
-        • Add brief casual exchanges that feel natural
-        • Include moments of reflection or connection-making
-        • Balance technical depth with accessibility
-    
-    3. Maintain Quality:
-        • Keep all technical information accurate
-        • Ensure added content supports rather than distracts
-        • Preserve the core findings and insights
-        • Keep the overall length reasonable
-    
-    4. Add Engagement Techniques:
-        • Include thought-provoking analogies by both hosts
-        • Add relatable real-world examples
-        • Express enthusiasm through natural dialogue
-        • Include collaborative problem-solving moments
-        • Inject humor where appropriate and it has to be funny
-
-    Natural Reaction Examples:
-    ✓ RIGHT: "Oh, that's fascinating!"
-    ✓ RIGHT: "Wait, that doesn't make sense!"
-    ✓ RIGHT: "Wait, really? I hadn't thought of it that way."
-    ✓ RIGHT: "That's such a great point."
-    ✗ WRONG: *chuckles* or *laughs* or any other action markers
-    ✗ WRONG: Adding new speakers or changing host names
-    
-    The goal is to make the content feel like a conversation between Julia and Guido
-    who are genuinely excited about the topic, while ensuring listeners learn 
-    something valuable.""",
+    description="""Enhance the initial podcast script provided in the context. Follow the 
+    enhancement instructions, rules and output format in your instructions exactly.""",
     expected_output="An enhanced version of the podcast script that's more engaging and natural",
     agent=script_enhancer,
-    context=[summary_task, podcast_task],
+    context=[summary_task, supporting_research_task, podcast_task],
     output_pydantic=PodcastScript,
     output_file="output/metadata/enhanced_podcast_script.json"
 )
@@ -400,15 +495,208 @@ audio_task = Task(
     output_file="output/metadata/audio_generation_meta.json"
 )
 
-# --- Crew and Process ---
-crew = Crew(
-    agents=[researcher, research_support, script_writer, script_enhancer, audio_generator_agent],
-    tasks=[summary_task, supporting_research_task, podcast_task, enhance_script_task, audio_task],
+# --- Crews and Process ---
+# The pipeline runs as a fan-out/fan-in DAG: the summary feeds supporting research
+# and the first script draft, which run in parallel, and both are merged by the
+# enhancer before audio generation.
+# Every stage keeps the paper as knowledge, as the single crew did, so agents can
+# check details against the source rather than only the summary
+summary_crew = Crew(
+    agents=[researcher],
+    tasks=[summary_task],
     process=Process.sequential,
     knowledge_sources=[research_paper],
     verbose=True
 )
 
+support_crew = Crew(
+    agents=[research_support],
+    tasks=[supporting_research_task],
+    process=Process.sequential,
+    knowledge_sources=[research_paper],
+    verbose=True
+)
+
+script_crew = Crew(
+    agents=[script_writer],
+    tasks=[podcast_task],
+    process=Process.sequential,
+    knowledge_sources=[research_paper],
+    verbose=True
+)
+
+production_crew = Crew(
+    agents=[script_enhancer, audio_generator_agent],
+    tasks=[enhance_script_task, audio_task],
+    process=Process.sequential,
+    knowledge_sources=[research_paper],
+    verbose=True
+)
+
+def summary_cache_path() -> str:
+    """Cache path for the paper summary, keyed by the paper, model, prompt and output schema."""
+    key = hashlib.sha256("|".join([
+        file_digest(PAPER_PATH),
+        summary_llm.model,
+        summary_task.description,
+        summary_task.expected_output,
+        json.dumps(PaperSummary.model_json_schema(), sort_keys=True)
+    ]).encode()).hexdigest()
+    return os.path.join(SUMMARY_CACHE_DIR, f"{key}.json")
+
+def write_output_file(task: Task, text: str) -> None:
+    """Write a task's output file for stages that run outside crewAI."""
+    os.makedirs(os.path.dirname(task.output_file) or ".", exist_ok=True)
+    with open(task.output_file, "w") as f:
+        f.write(text)
+
+def load_cached_summary(path: str) -> None:
+    """Prefill the summary task's output from a cached summary."""
+    with open(path) as f:
+        raw = f.read()
+
+    summary_task.output = TaskOutput(
+        description=summary_task.description,
+        raw=raw,
+        pydantic=PaperSummary.model_validate_json(raw),
+        agent=researcher.role,
+        output_format=OutputFormat.PYDANTIC
+    )
+    write_output_file(summary_task, raw)
+
+def store_cached_summary(path: str) -> None:
+    """Save the summary task's output for reuse on the same paper."""
+    if summary_task.output is None:
+        return
+    try:
+        summary = PaperSummary.model_validate_json(summary_task.output.raw)
+    except ValidationError:
+        # Unstructured models' answers are only parsed by crewAI's converter
+        summary = summary_task.output.pydantic
+    if summary is None:
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(summary.model_dump_json())
+
+CODE_FENCE = re.compile(r"^\s*```[\w-]*\s*$", re.MULTILINE)  # Markdown fence lines around JSON replies
+
+def enhancer_messages() -> List[dict]:
+    """Build the enhancer prompt from the summary, research and draft script."""
+    context = "\n\n----------\n\n".join(task.output.raw for task in enhance_script_task.context)
+    return [
+        {
+            "role": "system",
+            "content": f"You are {script_enhancer.role}. {script_enhancer.backstory}\n"
+                       f"Your personal goal is: {script_enhancer.goal}"
+        },
+        {
+            "role": "user",
+            "content": f"{enhance_script_task.description}\n"
+                       f"Respond only with the JSON object.\n\n"
+                       f"This is the context you're working with:\n{context}"
+        }
+    ]
+
+def parse_enhanced_script(response: str, start: int = 0) -> PodcastScript:
+    """Decode the script object from the enhancer's reply, ignoring fences and prose around it.
+
+    Decoding starts at `start`, where the object is expected to begin; failing that,
+    each other object in the fence-stripped reply is tried in turn.
+    """
+    decoder = json.JSONDecoder()
+    unfenced = CODE_FENCE.sub("", response)
+    attempts = [(response, start)] + [(unfenced, i) for i, char in enumerate(unfenced) if char == "{"]
+
+    error = None
+    for text, offset in attempts:
+        try:
+            script, _ = decoder.raw_decode(text, offset)
+            return PodcastScript.model_validate(script)
+        except ValueError as e:  # Covers both JSON decode and pydantic validation errors
+            error = e
+    raise ValueError(f"Enhancer reply contains no valid podcast script: {error}")
+
+async def stream_enhanced_dialogue():
+    """Yield enhanced dialogue lines as soon as the enhancer finishes writing each one."""
+    response, start, fed, streamed = "", -1, 0, 0
+    parser, items, parsing = None, [], True
+
+    async for text in script_enhancer_llm.astream(enhancer_messages(), validate=parse_enhanced_script):
+        response += text
+        while parsing:
+            if parser is None:
+                # Skip any preamble or code fence up to the next candidate object
+                candidate = response.find("{", start + 1)
+                if candidate < 0:
+                    break
+                start, fed = candidate, candidate
+                items = ijson.sendable_list()
+                parser = ijson.items_coro(items, "dialogue.item")
+
+            try:
+                parser.send(response[fed:].encode())
+                fed = len(response)
+                break
+            except ijson.JSONError:
+                parser = None
+                # A brace in the preamble only fails before any line parses; once lines
+                # are out, the error is trailing prose and the full reply is decoded below
+                if streamed or items:
+                    parsing = False
+
+        for item in items:
+            streamed += 1
+            yield item
+        del items[:]
+
+    script = parse_enhanced_script(response, max(start, 0))
+    write_output_file(enhance_script_task, script.model_dump_json(indent=2))
+
+    # Synthesize anything the incremental parser could not recover
+    for line in script.dialogue[streamed:]:
+        yield line.model_dump()
+
+async def stream_production(inputs: dict) -> Union[AudioGeneration, CrewOutput]:
+    """Enhance the script and synthesize each line while the enhancer is still writing."""
+    try:
+        segment_files = await asyncio.to_thread(audio_generator.run_stream, stream_enhanced_dialogue())
+    except ValueError as e:
+        # The streamed reply never decoded to a script; let the crew redo the stage with
+        # its own retries rather than failing the run (identical lines come from the TTS cache)
+        print(f"Streamed enhancement failed, falling back to the production crew: {e}")
+        return await production_crew.kickoff_async(inputs=inputs)
+    final_podcast = await asyncio.to_thread(podcast_mixer.run, audio_files=segment_files)
+
+    result = AudioGeneration(segment_files=segment_files, final_podcast=final_podcast)
+    write_output_file(audio_task, result.model_dump_json(indent=2))
+    return result
+
+async def run_pipeline(inputs: dict):
+    """Run the podcast crews, overlapping the independent middle stage."""
+    # Skip the summary when neither the paper nor the summary prompt has changed
+    summary_cache = summary_cache_path()
+    if os.path.exists(summary_cache):
+        print(f"Reusing cached paper summary: {summary_cache}")
+        os.utime(summary_cache)  # Expiry goes by mtime, so count the TTL from last use
+        load_cached_summary(summary_cache)
+    else:
+        await summary_crew.kickoff_async(inputs=inputs)
+        store_cached_summary(summary_cache)
+
+    await asyncio.gather(
+        support_crew.kickoff_async(inputs=inputs),
+        script_crew.kickoff_async(inputs=inputs)
+    )
+
+    if os.getenv("PODCAST_STREAM_AUDIO", "1") == "1":
+        return await stream_production(inputs)
+
+    # kickoff_async runs the crew in a worker thread, leaving the audio tool free
+    # to drive its own event loop
+    return await production_crew.kickoff_async(inputs=inputs)
+
 if __name__ == "__main__":    
     # Update task output files
     summary_task.output_file = os.path.join(dirs['DATA'], "paper_summary.json")
@@ -418,4 +706,4 @@ if __name__ == "__main__":
     audio_task.output_file = os.path.join(dirs['DATA'], "audio_generation_meta.json")
     
     # Run the podcast generation process
-    results = crew.kickoff(inputs={"paper": "workplace-prod.pdf"})
\ No newline at end of file
+    results = asyncio.run(run_pipeline(inputs={"paper": PAPER_FILE}))
@@ -1,10 +1,43 @@
 import os
-from typing import Dict, List, Optional, Any, Type
+import json
+import shutil
+import atexit
+import asyncio
+import hashlib
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+import numpy as np
+from typing import Dict, List, Optional, Any, AsyncIterator, Tuple, Type
 from datetime import datetime
 from pydub import AudioSegment
 from crewai.tools import BaseTool
-from pydantic import Field, BaseModel, ConfigDict
-from elevenlabs.client import ElevenLabs
+from pydantic import Field, BaseModel, ConfigDict, PrivateAttr, model_validator
+from elevenlabs.client import AsyncElevenLabs
+from cache import CACHE_DIR, prune_cache_dir
+
+DRAFT_OUTPUT_FORMAT = "mp3_22050_32"  # Low-bitrate ElevenLabs output for draft runs
+
+
+def load_audio(filename: str, format: str) -> AudioSegment:
+    """Decode an audio file of known format without pydub's ffprobe round-trip."""
+    if format == "mp3":
+        # pydub only skips probing when the decoder is forced explicitly
+        return AudioSegment.from_file(filename, format="mp3", codec="mp3")
+    return AudioSegment.from_file(filename, format=format)
+
+
+def link_or_copy(source: str, destination: str) -> None:
+    """Hardlink a file into place, falling back to a copy where links aren't possible."""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Cross-filesystem links and some filesystems don't support hardlinks
+        shutil.copyfile(source, destination)
 
 class VoiceConfig(BaseModel):
     """Voice configuration settings."""
@@ -25,6 +58,19 @@ class AudioConfig(BaseModel):
     normalize: bool = True    # Normalize audio levels
     target_loudness: float = -14.0  # Standard podcast loudness (LUFS)
     compression_ratio: float = 2.0   # Light compression for voice
+    force_reencode: bool = False     # Re-export each segment; loudness is otherwise normalized once at mix time
+    # Fast low-bitrate mono renders while iterating; set PODCAST_DRAFT=0 for the final export
+    draft_mode: bool = Field(default_factory=lambda: os.getenv("PODCAST_DRAFT", "1") == "1")
+
+    @model_validator(mode="after")
+    def apply_draft_settings(self) -> "AudioConfig":
+        """Swap in speech-grade settings while drafting, keeping any the caller set."""
+        if self.draft_mode:
+            draft = {"sample_rate": 22050, "channels": 1, "bitrate": "64k"}
+            for name, value in draft.items():
+                if name not in self.model_fields_set:
+                    setattr(self, name, value)
+        return self
 
 class Dialogue(BaseModel):
     """Dialogue for the podcast audio generation tool."""
@@ -48,83 +94,248 @@ class PodcastAudioGenerator(BaseTool):
     audio_config: AudioConfig = Field(default_factory=AudioConfig)
     output_dir: str = Field(default="output/audio-files")
     client: Any = Field(default=None)
+    max_concurrency: int = Field(default=8)  # Parallel ElevenLabs requests
+    max_segment_chars: int = Field(default=2500)  # Cap for merged same-speaker lines
+    cache_dir: Optional[str] = Field(default=os.path.join(CACHE_DIR, "tts"))  # None disables the TTS cache
     args_schema: Type[BaseModel] = PodcastAudioGeneratorInput
 
+    _loop: Optional[asyncio.AbstractEventLoop] = PrivateAttr(default=None)
+    _loop_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _http: Optional[httpx.AsyncClient] = PrivateAttr(default=None)
+    _out: Optional[Path] = PrivateAttr(default=None)
+    _cpu_pool: Optional[ThreadPoolExecutor] = PrivateAttr(default=None)
+
     def __init__(self, **data):
         super().__init__(**data)
         if not self.api_key:
             raise ValueError("ELEVENLABS_API_KEY environment variable not set")
-        self.client = ElevenLabs(api_key=self.api_key)
+
+        # Multiplex all segment requests over a shared, long-lived HTTP/2 pool
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(
+                max_connections=32,
+                max_keepalive_connections=32,
+                keepalive_expiry=300.0
+            )
+        )
+        self._http = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(60.0, connect=5.0)
+        )
+        self.client = AsyncElevenLabs(api_key=self.api_key, httpx_client=self._http)
+        # Pooled connections are bound to the loop they were opened on, so every
+        # run goes through the same loop to keep them alive between tool calls
+        self._loop = asyncio.new_event_loop()
+        # Decode/encode work runs here so it overlaps with in-flight network I/O
+        self._cpu_pool = ThreadPoolExecutor(max_workers=max(2, (os.cpu_count() or 1) // 2))
+        atexit.register(self.close)
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        # Set up directories once rather than on every, possibly concurrent, run
+        self._out = Path(self.output_dir)
+        self._out.mkdir(parents=True, exist_ok=True)
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            prune_cache_dir(self.cache_dir)
 
     def add_voice(self, name: str, voice_id: str, config: Optional[VoiceConfig] = None) -> None:
         """Add a voice configuration."""
+        config = config or VoiceConfig()
+        if self.audio_config.draft_mode:
+            config = config.model_copy(update={"output_format": DRAFT_OUTPUT_FORMAT})
+
+        # Built once here so the per-segment hot path is plain dict lookups
+        settings = {
+            "stability": config.stability,
+            "similarity_boost": config.similarity_boost,
+            "style": config.style,
+            "use_speaker_boost": config.use_speaker_boost
+        }
         self.voice_configs[name] = {
             "voice_id": voice_id,
-            "config": config or VoiceConfig()
+            "model_id": config.model_id,
+            "output_format": config.output_format,
+            "voice_settings": settings,
+            "settings_hash": hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
         }
 
+    def close(self) -> None:
+        """Close the HTTP pool, event loop and worker threads; also run at interpreter exit."""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._run_on_loop(self._http.aclose())
+        with self._loop_lock:
+            self._loop.close()
+        self._cpu_pool.shutdown(wait=True)
+
+    def _run_on_loop(self, coro: Any) -> Any:
+        """Run a coroutine to completion on the tool's own event loop.
+
+        run_until_complete can't be nested inside a running loop, so when called from
+        async code the tool's loop is driven from a helper thread and the caller blocks
+        until it finishes, as with any synchronous tool call.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Serialize callers from different threads; a loop can only run once at a time
+            with self._loop_lock:
+                return self._loop.run_until_complete(coro)
+
+        with ThreadPoolExecutor(max_workers=1) as helper:
+            return helper.submit(self._run_on_loop, coro).result()
+
     def _run(self, dialogue: List[Dialogue]) -> List[str]:
         """Generate audio files for each script segment."""
-        os.makedirs(self.output_dir, exist_ok=True)
+        return self._run_on_loop(self._arun(dialogue))
+
+    def run_stream(self, dialogue: AsyncIterator[Dict]) -> List[str]:
+        """Generate audio files for dialogue lines as they arrive from an async stream."""
+        return self._run_on_loop(self._agenerate(dialogue))
+
+    async def _arun(self, dialogue: List[Dialogue]) -> List[str]:
+        """Generate audio files for all script segments concurrently."""
+        async def lines():
+            for segment in dialogue:
+                yield segment
+
+        return await self._agenerate(lines())
 
-        audio_files = []
-        for index, segment in enumerate(dialogue):
+    async def _agenerate(self, dialogue: AsyncIterator[Dict]) -> List[str]:
+        """Dispatch a TTS request for each segment as soon as it is available."""
+        # Bound in-flight requests to stay within ElevenLabs' concurrency limits
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def synth(index: int, segment: Dict) -> Optional[Tuple[int, str]]:
             speaker = segment.get('speaker', '').strip()
             text = segment.get('text', '').strip()
-            
+
             if not speaker or not text:
                 print(f"Skipping segment {index}: missing speaker or text")
-                continue
+                return None
 
             voice_config = self.voice_configs.get(speaker)
             if not voice_config:
                 print(f"Skipping unknown speaker: {speaker}")
-                continue
+                return None
+
+            filename = str(self._out / f"{index:03d}_{speaker}.{self.audio_config.format}")
+            cache_file = self._cache_file(voice_config, text)
 
             try:
-                audio_generator = self.client.text_to_speech.convert(
-                    text=text,
-                    voice_id=voice_config["voice_id"],
-                    model_id=voice_config['config'].model_id,
-                    output_format=voice_config['config'].output_format,
-                    voice_settings={
-                        "stability": voice_config['config'].stability,
-                        "similarity_boost": voice_config['config'].similarity_boost,
-                        "style": voice_config['config'].style,
-                        "use_speaker_boost": voice_config['config'].use_speaker_boost
-                    }
-                )
-
-                # Convert generator to bytes
-                audio_bytes = b''.join(chunk for chunk in audio_generator)
-
-                filename = f"{self.output_dir}/{index:03d}_{speaker}.{self.audio_config.format}"
-                with open(filename, "wb") as out:
-                    out.write(audio_bytes)
-
-                # Basic audio normalization
-                if self.audio_config.normalize:
-                    audio = AudioSegment.from_file(filename)
-                    normalized = audio.normalize()  # Simple normalization
-                    normalized = normalized + 4  # Slight boost
-                    
-                    # Use context manager to ensure file is closed
-                    with normalized.export(
-                        filename,
-                        format=self.audio_config.format,
-                        bitrate=self.audio_config.bitrate,
-                        parameters=["-ar", str(self.audio_config.sample_rate)]
-                    ) as f:
-                        f.close()
-
-                audio_files.append(filename)
-                print(f'Audio content written to file "{filename}"')
+                # Unchanged lines are served from the cache instead of the API
+                if cache_file and os.path.exists(cache_file):
+                    # Expiry goes by mtime, so refresh it to keep lines in use cached
+                    os.utime(cache_file)
+                    link_or_copy(cache_file, filename)
+                    print(f'Audio content reused from cache for "{filename}"')
+                else:
+                    audio_stream = self.client.text_to_speech.convert(
+                        text=text,
+                        voice_id=voice_config["voice_id"],
+                        model_id=voice_config["model_id"],
+                        output_format=voice_config["output_format"],
+                        voice_settings=voice_config["voice_settings"]
+                    )
+
+                    # Stream chunks to a fresh file and swap it in, so a segment left
+                    # hardlinked to a cache entry by an earlier run is never truncated
+                    streamed = f"{filename}.tmp"
+                    with open(streamed, "wb") as out:
+                        async for chunk in audio_stream:
+                            if chunk:
+                                out.write(chunk)
+                    os.replace(streamed, filename)
+
+                    if cache_file:
+                        # Stage under a unique name so concurrent identical lines can't interleave
+                        staged = f"{cache_file}.{index}.tmp"
+                        link_or_copy(filename, staged)
+                        os.replace(staged, cache_file)
+
+                    print(f'Audio content written to file "{filename}"')
+
+                # Per-segment normalization re-encodes and resamples, so it is opt-in
+                if self.audio_config.normalize and self.audio_config.force_reencode:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self._cpu_pool, self._normalize_file, filename
+                    )
+
+                return index, filename
 
             except Exception as e:
                 print(f"Error processing segment {index}: {str(e)}")
+                return None
+
+        async def sem_wrap(coro):
+            async with semaphore:
+                return await coro
+
+        tasks = []
+        try:
+            async for segment in self._coalesce(dialogue):
+                tasks.append(asyncio.create_task(sem_wrap(synth(len(tasks), segment))))
+        except Exception:
+            # Let in-flight requests finish before surfacing the stream failure
+            await asyncio.gather(*tasks)
+            raise
+
+        results = await asyncio.gather(*tasks)
+        return [filename for _, filename in sorted(r for r in results if r)]
+
+    def _normalize_file(self, filename: str) -> None:
+        """Normalize a segment in place and re-export it with the configured settings."""
+        audio = load_audio(filename, self.audio_config.format)
+        normalized = audio.normalize()  # Simple normalization
+        normalized = normalized + 4  # Slight boost
+
+        # Export beside the segment and swap it in, so a hardlinked cache entry
+        # sharing the segment's inode is never overwritten
+        staged = f"{filename}.tmp"
+        with normalized.export(
+            staged,
+            format=self.audio_config.format,
+            bitrate=self.audio_config.bitrate,
+            parameters=["-ar", str(self.audio_config.sample_rate)]
+        ) as f:
+            f.close()
+        os.replace(staged, filename)
+
+    def _cache_file(self, voice_config: Dict[str, Any], text: str) -> Optional[str]:
+        """Path of the cached audio for a line, or None when caching is disabled."""
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha256(
+            f"{voice_config['voice_id']}|{text}|{voice_config['settings_hash']}|"
+            f"{voice_config['model_id']}|{voice_config['output_format']}".encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.{self.audio_config.format}")
+
+    async def _coalesce(self, dialogue: AsyncIterator[Dict]) -> AsyncIterator[Dict[str, str]]:
+        """Merge consecutive lines from the same speaker into single TTS requests."""
+        pending = None
+        async for segment in dialogue:
+            speaker = segment.get('speaker', '').strip()
+            text = segment.get('text', '').strip()
+
+            if (
+                pending and pending['text'] and speaker and text
+                and pending['speaker'] == speaker
+                and len(pending['text']) + len(text) + 1 <= self.max_segment_chars
+            ):
+                pending['text'] += " " + text
                 continue
 
-        return sorted(audio_files)
+            if pending is not None:
+                yield pending
+            pending = {'speaker': speaker, 'text': text}
+
+        if pending is not None:
+            yield pending
 
 class PodcastMixer(BaseTool):
     """Enhanced audio mixing tool for podcast production."""
@@ -135,6 +346,14 @@ class PodcastMixer(BaseTool):
     audio_config: AudioConfig = Field(default_factory=AudioConfig)
     output_dir: str = Field(default="output/podcast")
 
+    _out: Optional[Path] = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        # Create output directory once up front
+        self._out = Path(self.output_dir)
+        self._out.mkdir(parents=True, exist_ok=True)
+
     def _run(
         self,
         audio_files: List[str],
@@ -144,32 +363,117 @@ class PodcastMixer(BaseTool):
             raise ValueError("No audio files provided to mix")
 
         try:
-            # Create output directory if it doesn't exist
-            os.makedirs(self.output_dir, exist_ok=True)
-            
-            mixed = AudioSegment.from_file(audio_files[0])
-            for audio_file in audio_files[1:]:
-                next_segment = AudioSegment.from_file(audio_file)
-                # Add silence and use crossfade
-                silence = AudioSegment.silent(duration=200)
-                next_segment = silence + next_segment
-                mixed = mixed.append(next_segment, crossfade=crossfade)
+            samples, frame_rate, channels = self._mix(audio_files, crossfade)
 
             # Simplified output path handling
-            output_file = os.path.join(self.output_dir, "podcast_final.mp3")
-            
-            mixed.export(
-                output_file,
-                format="mp3",
-                parameters=[
-                    "-q:a", "0",  # Highest quality
-                    "-ar", "48000"  # Professional sample rate
-                ]
+            output_file = str(self._out / "podcast_final.mp3")
+
+            # Loudness-normalize and encode the mixed PCM in a single ffmpeg pass
+            subprocess.run(
+                self._encode_command(frame_rate, channels, output_file),
+                input=samples.tobytes(),
+                check=True,
+                capture_output=True
             )
 
             print(f"Successfully mixed podcast to: {output_file}")
             return output_file
 
+        except subprocess.CalledProcessError as e:
+            print(f"Error mixing podcast: {e.stderr.decode(errors='replace')}")
+            return ""
+
         except Exception as e:
             print(f"Error mixing podcast: {str(e)}")
-            return ""
\ No newline at end of file
+            return ""
+
+    def _mix(self, audio_files: List[str], crossfade: int) -> Tuple[np.ndarray, int, int]:
+        """Decode each segment once and crossfade them into a single int16 buffer."""
+        segments = [load_audio(audio_file, self.audio_config.format) for audio_file in audio_files]
+        frame_rate, channels = segments[0].frame_rate, segments[0].channels
+        arrays = [
+            np.frombuffer(
+                segment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(2).raw_data,
+                dtype=np.int16
+            ).reshape(-1, channels)
+            for segment in segments
+        ]
+
+        gap = frame_rate * 200 // 1000  # Silence before every segment after the first
+        fade = frame_rate * crossfade // 1000
+
+        # Lay out all segments first so the output is allocated exactly once
+        starts, overlaps = [0], [0]
+        cursor = len(arrays[0])
+        for samples in arrays[1:]:
+            overlap = min(fade, cursor, gap + len(samples))
+            starts.append(cursor - overlap + gap)
+            overlaps.append(overlap)
+            cursor = cursor - overlap + gap + len(samples)
+
+        out = np.zeros((cursor, channels), dtype=np.float32)
+        for samples, start, overlap in zip(arrays, starts, overlaps):
+            segment = samples.astype(np.float32)
+            if overlap:
+                # Fade out the mix's tail while the silence-led segment fades in
+                fade_start = start - gap
+                out[fade_start:fade_start + overlap] *= np.linspace(1, 0, overlap, dtype=np.float32)[:, None]
+                audible = overlap - gap
+                if audible > 0:
+                    segment[:audible] *= np.linspace(0, 1, overlap, dtype=np.float32)[gap:, None]
+            out[start:start + len(segment)] += segment
+
+        return np.clip(out, -32768, 32767).astype(np.int16), frame_rate, channels
+
+    def _encode_command(self, frame_rate: int, channels: int, output_file: str) -> List[str]:
+        """Build the ffmpeg command that encodes raw PCM from stdin to the final podcast."""
+        command = [
+            AudioSegment.converter, "-y",
+            "-f", "s16le", "-ar", str(frame_rate), "-ac", str(channels), "-i", "pipe:0"
+        ]
+        if self.audio_config.normalize:
+            command += ["-af", f"loudnorm=I={self.audio_config.target_loudness}:TP=-1.5:LRA=11"]
+
+        return command + [
+            "-b:a", self.audio_config.bitrate,
+            "-ar", str(self.audio_config.sample_rate),
+            "-ac", str(self.audio_config.channels),
+            output_file
+        ]
+
+class ParallelSearchInput(BaseModel):
+    """Input for the parallel web search tool."""
+    queries: List[str] = Field(..., description="Search queries to run at the same time")
+
+class ParallelSearchTool(BaseTool):
+    """Runs a batch of web searches concurrently and merges their results."""
+
+    name: str = "ParallelWebSearch"
+    description: str = (
+        "Searches the web for several queries at once. Batch all related queries "
+        "into a single call instead of searching one query at a time."
+    )
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    search_tool: Any = Field(default=None)  # Tool taking a `search_query` argument, e.g. SerperDevTool
+    max_concurrency: int = Field(default=8)
+    args_schema: Type[BaseModel] = ParallelSearchInput
+
+    def _run(self, queries: List[str]) -> str:
+        return asyncio.run(self._arun(queries))
+
+    async def _arun(self, queries: List[str]) -> str:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def search(query: str) -> str:
+            async with semaphore:
+                try:
+                    result = await asyncio.to_thread(self.search_tool.run, search_query=query)
+                except Exception as e:
+                    result = f"Search failed: {str(e)}"
+            return f"## Results for: {query}\n{result}"
+
+        results = await asyncio.gather(*(search(query) for query in queries))
+        return "\n\n".join(results)
+